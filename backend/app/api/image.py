@@ -1,9 +1,16 @@
 import asyncio
+import base64
+import binascii
 import httpx
 import logging
+import orjson
+import os
+import re
+from functools import lru_cache
 from typing import Optional, List, Dict, Any
-from fastapi import APIRouter, HTTPException, BackgroundTasks
-from pydantic import BaseModel, Field, validator
+from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, field_validator, ValidationInfo
 import time
 from app.utils.load_balancer import get_load_balancer
 
@@ -11,6 +18,53 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/v1", tags=["image"])
 
+# Global cap on concurrent outbound calls to SiliconFlow so request bursts
+# cannot open unbounded sockets and saturate the connection pool
+_SF_MAX_CONCURRENCY = int(os.getenv("SF_MAX_CONCURRENCY", "64"))
+_sf_sem = asyncio.Semaphore(_SF_MAX_CONCURRENCY)
+
+# In-flight upstream calls keyed by request parameters, so identical
+# concurrent requests (e.g. duplicate clicks) share one upstream call
+_inflight: Dict[tuple, asyncio.Future] = {}
+
+# Ratio format -> pixel format mapping shared by all endpoints
+_SIZE_MAP = {
+    '1:1': '1024x1024',    # 正方形
+    '1:2': '640x1536',     # 竖屏 1:2
+    '3:2': '1664x928',     # 横屏 3:2
+    '3:4': '928x1664',     # 竖屏 3:4
+    '16:9': '1280x720',    # 横屏 16:9
+    '9:16': '720x1280'     # 竖屏 9:16
+}
+
+def _convert_size(size_str: str) -> str:
+    """Convert ratio format to pixel format if needed"""
+    return _SIZE_MAP.get(size_str, size_str)
+
+def _parse_retry_after(response: httpx.Response) -> Optional[float]:
+    """Parse a numeric Retry-After header; None if absent or not numeric"""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+# Validation constants: frozensets give O(1) membership checks, and the
+# regex accepts any explicit WxH resolution beyond the known presets
+_ALLOWED_MODELS = frozenset({"Kwai-Kolors/Kolors", "Qwen/Qwen-Image"})
+_ALLOWED_RATIOS = frozenset({"1:1", "1:2", "3:2", "3:4", "16:9", "9:16"})
+_ALLOWED_SIZES = frozenset({
+    "1024x1024", "1328x1328", "1664x928", "928x1664",
+    "1280x720", "720x1280", "1536x640", "640x1536"
+})
+_SIZE_RE = re.compile(r"^[0-9]{3,4}x[0-9]{3,4}$")
+
+def get_http_client(request: Request) -> httpx.AsyncClient:
+    """Get the shared app-lifetime HTTP client created in the lifespan hook"""
+    return request.app.state.http_client
+
 class ImageGenerationRequest(BaseModel):
     prompt: str = Field(..., min_length=1, max_length=2000, description="Text prompt for image generation")
     negative_prompt: Optional[str] = Field(None, max_length=2000, description="Negative prompt")
@@ -23,29 +77,31 @@ class ImageGenerationRequest(BaseModel):
     cfg: Optional[float] = Field(None, ge=0.1, le=20, description="CFG parameter for Qwen models")
     image: Optional[str] = Field(None, description="Reference image in base64 format")
 
-    @validator('model')
+    @field_validator('model', mode='after')
+    @classmethod
     def validate_model(cls, v):
-        allowed_models = ["Kwai-Kolors/Kolors", "Qwen/Qwen-Image"]
-        if v not in allowed_models:
-            raise ValueError(f"Model must be one of {allowed_models}")
+        if v not in _ALLOWED_MODELS:
+            raise ValueError(f"Model must be one of {sorted(_ALLOWED_MODELS)}")
         return v
 
-    @validator('image_size')
+    @field_validator('image_size', mode='after')
+    @classmethod
     def validate_image_size(cls, v):
-        # Allow both ratio format (1:1) and pixel format (1024x1024)
-        allowed_ratios = ["1:1", "1:2", "3:2", "3:4", "16:9", "9:16"]
-        allowed_sizes = [
-            "1024x1024", "1328x1328", "1664x928", "928x1664",
-            "1280x720", "720x1280", "1536x640", "640x1536"
-        ]
-        if v not in allowed_ratios and v not in allowed_sizes:
-            raise ValueError(f"Image size must be one of {allowed_ratios} or {allowed_sizes}")
-        return v
+        # Allow ratio format (1:1), known presets, or any explicit WxH size
+        if v in _ALLOWED_RATIOS or v in _ALLOWED_SIZES:
+            return v
+        if _SIZE_RE.match(v):
+            return v
+        raise ValueError(
+            f"Image size must be one of {sorted(_ALLOWED_RATIOS)} "
+            f"or a pixel size such as {sorted(_ALLOWED_SIZES)}"
+        )
 
-    @validator('cfg')
-    def validate_cfg(cls, v, values):
-        if v is not None and 'model' in values:
-            if not values['model'].startswith('Qwen/'):
+    @field_validator('cfg', mode='after')
+    @classmethod
+    def validate_cfg(cls, v, info: ValidationInfo):
+        if v is not None and 'model' in info.data:
+            if not info.data['model'].startswith('Qwen/'):
                 raise ValueError("CFG parameter is only available for Qwen models")
         return v
 
@@ -63,6 +119,7 @@ class GenerationStatus(BaseModel):
 
 async def generate_image_with_retry(
     request_data: Dict[str, Any],
+    client: httpx.AsyncClient,
     max_retries: int = 3,
     base_delay: float = 1.0
 ) -> Dict[str, Any]:
@@ -70,7 +127,9 @@ async def generate_image_with_retry(
     load_balancer = get_load_balancer()
 
     for attempt in range(max_retries):
-        api_key = load_balancer.get_available_key()
+        # Quota is reserved atomically at acquire time, so parallel callers
+        # cannot over-allocate the same key
+        api_key = await load_balancer.acquire_key()
         if not api_key:
             raise HTTPException(
                 status_code=503,
@@ -78,63 +137,75 @@ async def generate_image_with_retry(
             )
 
         try:
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                headers = {
-                    "Authorization": f"Bearer {api_key}",
-                    "Content-Type": "application/json"
-                }
+            headers = {
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json"
+            }
 
-                start_time = time.time()
+            start_time = time.time()
+            async with _sf_sem:
                 response = await client.post(
                     "https://api.siliconflow.cn/v1/images/generations",
                     headers=headers,
-                    json=request_data
+                    content=orjson.dumps(request_data)
                 )
-                inference_time = time.time() - start_time
-
-                if response.status_code == 200:
-                    load_balancer.record_success(api_key)
-                    result = response.json()
-
-                    # Standardize response format
-                    standardized_result = {
-                        "images": result.get("images", []),
-                        "seed": result.get("seed", 0),
-                        "inference_time": result.get("timings", {}).get("inference", inference_time),
-                        "model": request_data.get("model", "Kwai-Kolors/Kolors")
-                    }
-
-                    return standardized_result
-                elif response.status_code == 429:
-                    # Rate limit exceeded
-                    load_balancer.record_failure(api_key)
-                    logger.warning(f"Rate limit exceeded for key {api_key[:10]}...")
-                    if attempt < max_retries - 1:
+            inference_time = time.time() - start_time
+
+            if response.status_code == 200:
+                load_balancer.record_success(api_key)
+                result = orjson.loads(response.content)
+
+                # Standardize response format
+                standardized_result = {
+                    "images": result.get("images", []),
+                    "seed": result.get("seed", 0),
+                    "inference_time": result.get("timings", {}).get("inference", inference_time),
+                    "model": request_data.get("model", "Kwai-Kolors/Kolors")
+                }
+
+                return standardized_result
+            elif response.status_code == 429:
+                # Rate limit exceeded - upstream counted the request, keep the reservation
+                retry_after = _parse_retry_after(response)
+                load_balancer.record_rate_limit(api_key, retry_after)
+                logger.warning(f"Rate limit exceeded for key {api_key[:10]}...")
+                if attempt < max_retries - 1:
+                    # Obey the upstream reset time when given, otherwise back off
+                    if retry_after is not None:
+                        await asyncio.sleep(retry_after)
+                    else:
                         await asyncio.sleep(base_delay * (2 ** attempt))
-                        continue
-                elif response.status_code == 401:
-                    # Unauthorized - mark key as failed
-                    load_balancer.record_failure(api_key)
-                    logger.error(f"Unauthorized API key: {api_key[:10]}...")
                     continue
-                else:
-                    # Other errors
-                    load_balancer.record_failure(api_key)
-                    error_detail = response.text
-                    logger.error(f"API error {response.status_code}: {error_detail}")
-                    raise HTTPException(
-                        status_code=response.status_code,
-                        detail=f"API error: {error_detail}"
-                    )
+            elif response.status_code == 401:
+                # Unauthorized - mark key as failed
+                load_balancer.record_failure(api_key)
+                await load_balancer.release_reservation(api_key)
+                logger.error(f"Unauthorized API key: {api_key[:10]}...")
+                continue
+            else:
+                # Other errors
+                load_balancer.record_failure(api_key)
+                await load_balancer.release_reservation(api_key)
+                error_detail = response.text
+                logger.error(f"API error {response.status_code}: {error_detail}")
+                raise HTTPException(
+                    status_code=response.status_code,
+                    detail=f"API error: {error_detail}"
+                )
 
+        except HTTPException:
+            # Already recorded and released above
+            raise
         except httpx.TimeoutException:
             load_balancer.record_failure(api_key)
+            await load_balancer.release_reservation(api_key)
             logger.error(f"Timeout for API key: {api_key[:10]}...")
             if attempt < max_retries - 1:
                 await asyncio.sleep(base_delay * (2 ** attempt))
                 continue
         except Exception as e:
             load_balancer.record_failure(api_key)
+            await load_balancer.release_reservation(api_key)
             logger.error(f"Unexpected error: {str(e)}")
             if attempt < max_retries - 1:
                 await asyncio.sleep(base_delay * (2 ** attempt))
@@ -145,52 +216,113 @@ async def generate_image_with_retry(
         detail="Failed to generate image after multiple retries"
     )
 
+async def _build_parallel_tasks(
+    request: ImageGenerationRequest,
+    client: httpx.AsyncClient,
+    raw: bool = False
+) -> List:
+    """Reserve API keys and build one generation coroutine per requested image"""
+    await _validate_ref_image(request)
+
+    load_balancer = get_load_balancer()
+
+    api_keys: List[str] = []
+    if request.batch_size == 1:
+        # Single-image requests get sticky key affinity: repeat prompts hit
+        # the same key so any upstream caching can be reused
+        affinity = f"{request.model}:{request.prompt}:{request.seed}"
+        sticky_key = await load_balancer.acquire_sticky_key(affinity)
+        if sticky_key:
+            api_keys = [sticky_key]
+
+    if not api_keys:
+        # Reserve quota on multiple keys atomically for parallel requests
+        api_keys = await load_balancer.acquire_keys(request.batch_size)
+
+    if len(api_keys) == 0:
+        raise HTTPException(status_code=503, detail="No API keys available")
+
+    # If there are fewer distinct keys than requests, reserve additional
+    # slots on keys that still have quota left
+    while len(api_keys) < request.batch_size:
+        extra_key = await load_balancer.acquire_key()
+        if extra_key is None:
+            break
+        api_keys.append(extra_key)
+
+    if len(api_keys) < request.batch_size:
+        # Last resort: cycle through the reserved keys with some repetition,
+        # reserving each reuse (even past quota) so every dispatched task is
+        # matched by exactly one reservation and releases stay balanced
+        reserved_pool = list(api_keys)
+        for i in range(request.batch_size - len(api_keys)):
+            key = reserved_pool[i % len(reserved_pool)]
+            await load_balancer.reserve_extra(key)
+            api_keys.append(key)
+
+    # Serialize the request once; per-image dicts are cheap overlays on it
+    base = request.model_dump()
+    resolved_size = _convert_size(base['image_size'])
+
+    # Create individual requests
+    worker = generate_single_image_raw if raw else generate_single_image_with_key
+    tasks = []
+    for i in range(request.batch_size):
+        individual_request = {
+            **base,
+            'batch_size': 1,               # Each request generates 1 image
+            'seed': (request.seed or 0) + i,  # Different seed for each
+            'image_size': resolved_size
+        }
+
+        # Create the generation task
+        task = worker(individual_request, api_keys[i % len(api_keys)], client)
+        tasks.append(task)
+
+    return tasks
+
+@router.post("/generate-parallel/stream")
+async def generate_parallel_images_stream(
+    request: ImageGenerationRequest,
+    client: httpx.AsyncClient = Depends(get_http_client)
+):
+    """Generate multiple images in parallel, streaming each one as it completes.
+
+    Emits one NDJSON line per image, so clients can render the first image
+    after min(latencies) instead of waiting for the slowest request.
+    """
+    if request.batch_size > 10:
+        raise HTTPException(status_code=400, detail="Maximum batch size is 10")
+
+    tasks = await _build_parallel_tasks(request, client, raw=True)
+
+    async def stream_results():
+        failed_count = 0
+        for future in asyncio.as_completed(tasks):
+            try:
+                body = await future
+            except Exception as e:
+                failed_count += 1
+                logger.error(f"Parallel generation failed: {e}")
+                yield orjson.dumps({"error": str(e)}) + b"\n"
+                continue
+            # Forward the upstream JSON as-is; valid JSON cannot contain
+            # literal newlines, so stripping them keeps each result one line
+            yield body.replace(b"\n", b"") + b"\n"
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
 @router.post("/generate-parallel")
-async def generate_parallel_images(request: ImageGenerationRequest):
+async def generate_parallel_images(
+    request: ImageGenerationRequest,
+    client: httpx.AsyncClient = Depends(get_http_client)
+):
     """Generate multiple images using parallel API calls with different keys"""
     try:
         if request.batch_size > 10:
             raise HTTPException(status_code=400, detail="Maximum batch size is 10")
 
-        load_balancer = get_load_balancer()
-
-        # Get multiple API keys for parallel requests
-        api_keys = load_balancer.get_multiple_available_keys(request.batch_size)
-
-        if len(api_keys) < request.batch_size:
-            # Fall back to using available keys with some repetition
-            available_count = len(api_keys)
-            if available_count == 0:
-                raise HTTPException(status_code=503, detail="No API keys available")
-
-            # Cycle through available keys
-            while len(api_keys) < request.batch_size:
-                api_keys.extend(api_keys[:min(available_count, request.batch_size - len(api_keys))])
-
-        # Convert ratio format to pixel format if needed
-        def convert_image_size(size_str):
-            size_map = {
-                '1:1': '1024x1024',    # 正方形
-                '1:2': '640x1536',     # 竖屏 1:2
-                '3:2': '1664x928',     # 横屏 3:2
-                '3:4': '928x1664',     # 竖屏 3:4
-                '16:9': '1280x720',    # 横屏 16:9
-                '9:16': '720x1280'     # 竖屏 9:16
-            }
-            return size_map.get(size_str, size_str)
-
-        # Create individual requests
-        tasks = []
-        for i in range(request.batch_size):
-            # Prepare individual request data
-            individual_request = request.dict()
-            individual_request['batch_size'] = 1  # Each request generates 1 image
-            individual_request['seed'] = (request.seed or 0) + i  # Different seed for each
-            individual_request['image_size'] = convert_image_size(individual_request['image_size'])  # Convert ratio to pixels
-
-            # Create the generation task
-            task = generate_single_image_with_key(individual_request, api_keys[i % len(api_keys)])
-            tasks.append(task)
+        tasks = await _build_parallel_tasks(request, client)
 
         # Execute all requests in parallel
         results = await asyncio.gather(*tasks, return_exceptions=True)
@@ -223,7 +355,8 @@ async def generate_parallel_images(request: ImageGenerationRequest):
             seed=request.seed or 0,
             inference_time=total_inference_time / len(successful_results) if successful_results else 0,
             model=request.model,
-            parameters=request.dict()
+            # Don't echo the multi-megabyte base64 reference image back
+            parameters=request.model_dump(exclude={"image"})
         )
 
     except HTTPException:
@@ -232,101 +365,228 @@ async def generate_parallel_images(request: ImageGenerationRequest):
         logger.error(f"Unexpected error in parallel generation: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error during parallel generation")
 
-async def generate_single_image_with_key(request_data: Dict[str, Any], api_key: str) -> Dict[str, Any]:
+@lru_cache(maxsize=64)
+def _request_template(model: str, size: Optional[str], step: Optional[int]) -> Dict[str, Any]:
+    """Precomputed base payload shared by all requests with the same shape.
+
+    A batch of N images reuses one template instead of rebuilding the same
+    conditional dict N times; callers overlay it, never mutate it.
+    """
+    template: Dict[str, Any] = {"model": model}
+    if size:
+        template["size"] = size
+    # For Kolors model, use 'step' instead of 'num_inference_steps'
+    if step:
+        template["step"] = step
+    return template
+
+def _simplify_request(request_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the simplified upstream request format based on official docs"""
+    template = _request_template(
+        request_data.get("model", "Kwai-Kolors/Kolors"),
+        request_data.get("size") or request_data.get("image_size"),
+        request_data.get("num_inference_steps")
+    )
+    simplified_request = {**template, "prompt": request_data.get("prompt")}
+
+    # Overlay the per-request parameters only when they are set
+    if request_data.get("batch_size", 1) > 1:
+        simplified_request["n"] = request_data["batch_size"]
+    if request_data.get("seed"):
+        simplified_request["seed"] = request_data["seed"]
+    if request_data.get("negative_prompt"):
+        simplified_request["negative_prompt"] = request_data["negative_prompt"]
+    if request_data.get("image"):
+        simplified_request["image"] = request_data["image"]
+
+    return simplified_request
+
+def _loggable_request(simplified_request: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy of an upstream payload safe to log: the base64 reference image
+    can be megabytes, so only its length is recorded"""
+    image = simplified_request.get("image")
+    if image is None:
+        return simplified_request
+    return {**simplified_request, "image": f"<{len(image)} base64 chars>"}
+
+async def _decode_ref_image(b64: str) -> bytes:
+    """Decode a base64 reference image without blocking the event loop.
+
+    Reference images can be several megabytes; decoding them inline would
+    stall every other coroutine, so the decode runs in a worker thread.
+    """
+    return await asyncio.to_thread(base64.b64decode, b64, validate=True)
+
+async def _validate_ref_image(request: ImageGenerationRequest):
+    """Reject invalid base64 reference images before any quota is spent"""
+    if not request.image:
+        return
+    try:
+        await _decode_ref_image(request.image)
+    except (ValueError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Invalid base64 reference image")
+
+async def generate_single_image_with_key(
+    request_data: Dict[str, Any],
+    api_key: str,
+    client: httpx.AsyncClient
+) -> Dict[str, Any]:
     """Generate a single image using a specific API key"""
     load_balancer = get_load_balancer()
 
+    simplified_request = _simplify_request(request_data)
+    logger.info(f"Sending request: {_loggable_request(simplified_request)}")
+
+    # Coalesce identical in-flight requests into a single upstream call
+    coalesce_key = tuple(sorted(simplified_request.items()))
+    existing = _inflight.get(coalesce_key)
+    if existing is not None:
+        logger.info("Coalescing duplicate in-flight generation request")
+        await load_balancer.release_reservation(api_key)
+        return await existing
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[coalesce_key] = future
     try:
-        # Prepare simplified request format based on official docs
-        simplified_request = {
-            "model": request_data.get("model", "Kwai-Kolors/Kolors"),
-            "prompt": request_data.get("prompt")
-        }
+        result = await _call_siliconflow(simplified_request, api_key, client)
+    except Exception as e:
+        if not future.done():
+            future.set_exception(e)
+            # Mark retrieved in case no duplicate caller awaits this future
+            future.exception()
+        raise
+    else:
+        if not future.done():
+            future.set_result(result)
+        return result
+    finally:
+        _inflight.pop(coalesce_key, None)
+
+async def _call_siliconflow(
+    simplified_request: Dict[str, Any],
+    api_key: str,
+    client: httpx.AsyncClient
+) -> Dict[str, Any]:
+    """Issue one generation call to SiliconFlow and update key accounting"""
+    load_balancer = get_load_balancer()
 
-        # Add optional parameters only if they exist and are valid
-        if request_data.get("size"):
-            simplified_request["size"] = request_data["size"]
-        elif request_data.get("image_size"):
-            simplified_request["size"] = request_data["image_size"]
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
 
-        # For Kolors model, use 'step' instead of 'num_inference_steps'
-        if request_data.get("num_inference_steps"):
-            simplified_request["step"] = request_data["num_inference_steps"]
+    try:
+        start_time = time.time()
+        async with _sf_sem:
+            response = await client.post(
+                "https://api.siliconflow.cn/v1/images/generations",
+                headers=headers,
+                content=orjson.dumps(simplified_request)
+            )
+        inference_time = time.time() - start_time
+    except Exception:
+        # Network-level failure: the reserved quota was never spent upstream
+        load_balancer.record_failure(api_key)
+        await load_balancer.release_reservation(api_key)
+        raise
 
-        # Add batch size (n parameter)
-        if request_data.get("batch_size", 1) > 1:
-            simplified_request["n"] = request_data["batch_size"]
+    logger.debug(f"SiliconFlow responded over {response.http_version}")
 
-        # Add seed if provided
-        if request_data.get("seed"):
-            simplified_request["seed"] = request_data["seed"]
+    if response.status_code == 200:
+        load_balancer.record_success(api_key)
+        result = orjson.loads(response.content)
 
-        # Add negative prompt if provided
-        if request_data.get("negative_prompt"):
-            simplified_request["negative_prompt"] = request_data["negative_prompt"]
+        # Standardize response format
+        standardized_result = {
+            "images": result.get("images", []),
+            "seed": result.get("seed", 0),
+            "inference_time": result.get("timings", {}).get("inference", inference_time),
+            "model": simplified_request["model"]
+        }
 
-        logger.info(f"Sending request: {simplified_request}")
+        return standardized_result
 
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            }
+    if response.status_code == 429:
+        # Upstream counted the request: keep the reservation and honor its reset time
+        load_balancer.record_rate_limit(api_key, _parse_retry_after(response))
+    else:
+        load_balancer.record_failure(api_key)
+        await load_balancer.release_reservation(api_key)
+    error_detail = response.text
+    logger.error(f"API error {response.status_code}: {error_detail}")
+    raise Exception(f"API error: {error_detail}")
 
-            start_time = time.time()
-            response = await client.post(
-                "https://api.siliconflow.cn/v1/images/generations",
-                headers=headers,
-                json=simplified_request
-            )
-            inference_time = time.time() - start_time
+async def generate_single_image_raw(
+    request_data: Dict[str, Any],
+    api_key: str,
+    client: httpx.AsyncClient
+) -> bytes:
+    """Generate a single image, returning the upstream JSON body untouched.
+
+    The base64 image payloads are never materialized as Python objects, so
+    large batches avoid decoding and re-encoding megabytes of image data.
+    """
+    load_balancer = get_load_balancer()
 
-            if response.status_code == 200:
-                load_balancer.record_success(api_key)
-                result = response.json()
+    simplified_request = _simplify_request(request_data)
+    logger.info(f"Sending request: {_loggable_request(simplified_request)}")
 
-                # Standardize response format
-                standardized_result = {
-                    "images": result.get("images", []),
-                    "seed": result.get("seed", 0),
-                    "inference_time": result.get("timings", {}).get("inference", inference_time),
-                    "model": simplified_request["model"]
-                }
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
 
-                return standardized_result
-            else:
-                load_balancer.record_failure(api_key)
-                error_detail = response.text
-                logger.error(f"API error {response.status_code}: {error_detail}")
-                raise Exception(f"API error: {error_detail}")
+    try:
+        async with _sf_sem:
+            async with client.stream(
+                "POST",
+                "https://api.siliconflow.cn/v1/images/generations",
+                headers=headers,
+                content=orjson.dumps(simplified_request)
+            ) as response:
+                body = bytearray()
+                async for chunk in response.aiter_bytes():
+                    body += chunk
+    except Exception:
+        # Network-level failure: the reserved quota was never spent upstream
+        load_balancer.record_failure(api_key)
+        await load_balancer.release_reservation(api_key)
+        raise
 
-    except Exception as e:
+    if response.status_code == 200:
+        load_balancer.record_success(api_key)
+        return bytes(body)
+
+    if response.status_code == 429:
+        # Upstream counted the request: keep the reservation and honor its reset time
+        load_balancer.record_rate_limit(api_key, _parse_retry_after(response))
+    else:
         load_balancer.record_failure(api_key)
-        raise e
+        await load_balancer.release_reservation(api_key)
+    error_detail = body.decode("utf-8", errors="replace")
+    logger.error(f"API error {response.status_code}: {error_detail}")
+    raise Exception(f"API error: {error_detail}")
 
 @router.post("/generate", response_model=ImageGenerationResponse)
-async def generate_image(request: ImageGenerationRequest):
+async def generate_image(
+    request: ImageGenerationRequest,
+    client: httpx.AsyncClient = Depends(get_http_client)
+):
     """Generate images using SiliconFlow API"""
     try:
-        # Convert ratio format to pixel format if needed
-        def convert_image_size(size_str):
-            size_map = {
-                '1:1': '1024x1024',    # 正方形
-                '1:2': '640x1536',     # 竖屏 1:2
-                '3:2': '1664x928',     # 横屏 3:2
-                '3:4': '928x1664',     # 竖屏 3:4
-                '16:9': '1280x720',    # 横屏 16:9
-                '9:16': '720x1280'     # 竖屏 9:16
-            }
-            return size_map.get(size_str, size_str)
+        await _validate_ref_image(request)
 
         # Prepare simplified request format for SiliconFlow API
         request_data = {
             "model": request.model,
             "prompt": request.prompt,
-            "size": convert_image_size(request.image_size)
+            "size": _convert_size(request.image_size)
         }
 
+        # Forward the reference image as base64 text (validated above)
+        if request.image:
+            request_data["image"] = request.image
+
         # Add step parameter (instead of num_inference_steps)
         if request.num_inference_steps:
             request_data["step"] = request.num_inference_steps
@@ -346,7 +606,7 @@ async def generate_image(request: ImageGenerationRequest):
         # We'll focus on the basic parameters that work
 
         # Generate image
-        result = await generate_image_with_retry(request_data)
+        result = await generate_image_with_retry(request_data, client)
 
         # Extract response data
         images = result.get("images", [])
@@ -358,7 +618,8 @@ async def generate_image(request: ImageGenerationRequest):
             seed=seed,
             inference_time=inference_time,
             model=request.model,
-            parameters=request_data
+            # Don't echo the multi-megabyte base64 reference image back
+            parameters={k: v for k, v in request_data.items() if k != "image"}
         )
 
     except HTTPException:
@@ -408,11 +669,11 @@ async def test_request(request: ImageGenerationRequest):
     return {
         "status": "success",
         "message": "Request data is valid",
-        "received_data": request.dict()
+        "received_data": request.model_dump()
     }
 
 @router.post("/test-single-api")
-async def test_single_api():
+async def test_single_api(client: httpx.AsyncClient = Depends(get_http_client)):
     """Test single API call to SiliconFlow"""
     load_balancer = get_load_balancer()
     api_key = load_balancer.get_available_key()
@@ -428,26 +689,26 @@ async def test_single_api():
             "size": "1024x1024"
         }
 
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            }
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
 
-            logger.info(f"Testing API with request: {test_request}")
+        logger.info(f"Testing API with request: {test_request}")
 
+        async with _sf_sem:
             response = await client.post(
                 "https://api.siliconflow.cn/v1/images/generations",
                 headers=headers,
-                json=test_request
+                content=orjson.dumps(test_request)
             )
 
-            return {
-                "status": "success" if response.status_code == 200 else "error",
-                "status_code": response.status_code,
-                "response": response.json() if response.status_code == 200 else response.text,
-                "request_sent": test_request
-            }
+        return {
+            "status": "success" if response.status_code == 200 else "error",
+            "status_code": response.status_code,
+            "response": orjson.loads(response.content) if response.status_code == 200 else response.text,
+            "request_sent": test_request
+        }
 
     except Exception as e:
         return {
@@ -1,11 +1,17 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse
+import gzip
+import httpx
 import logging
+import mimetypes
 import os
 from pathlib import Path
 from app.api import image
+from app.utils.load_balancer import get_load_balancer
 
 # Configure logging
 logging.basicConfig(
@@ -14,13 +20,40 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Manage app-lifetime resources"""
+    # Single shared HTTP client so all SiliconFlow calls reuse connections
+    # instead of paying a TLS handshake per request. HTTP/2 lets a whole
+    # parallel batch multiplex over one TLS session.
+    app.state.http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(120.0, connect=10.0),
+        limits=httpx.Limits(
+            max_connections=200,
+            max_keepalive_connections=100,
+            keepalive_expiry=60
+        ),
+        http2=True,
+        headers={"Accept-Encoding": "gzip, br"}
+    )
+    logger.info("Shared HTTP client initialized")
+    # Preload API keys at startup so no request ever waits on disk I/O
+    app.state.load_balancer = get_load_balancer()
+    # Precompress frontend assets once so responses skip per-request gzip
+    await asyncio.to_thread(_precompress_frontend_assets)
+    yield
+    await app.state.http_client.aclose()
+    logger.info("Shared HTTP client closed")
+
 # Create FastAPI app
 app = FastAPI(
     title="AI Drawing Website API",
     description="Backend API for AI-powered image generation using SiliconFlow",
     version="1.0.0",
     docs_url="/api/docs",
-    redoc_url="/api/redoc"
+    redoc_url="/api/redoc",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Configure CORS - Allow all origins for simplicity
@@ -52,21 +85,59 @@ async def root():
 
 # Serve static files in production
 frontend_dist_path = Path(__file__).parent.parent.parent / "frontend" / "dist"
+
+def _precompress_frontend_assets():
+    """Write .gz siblings for dist assets that lack an up-to-date one"""
+    if not frontend_dist_path.exists():
+        return
+    count = 0
+    for suffix in (".js", ".css", ".html"):
+        for asset in frontend_dist_path.rglob(f"*{suffix}"):
+            gz_path = asset.with_suffix(asset.suffix + ".gz")
+            if gz_path.exists() and gz_path.stat().st_mtime >= asset.stat().st_mtime:
+                continue
+            # Write to a temp file and rename so concurrent workers never
+            # serve a partially-written .gz
+            tmp_path = gz_path.with_suffix(gz_path.suffix + f".tmp{os.getpid()}")
+            tmp_path.write_bytes(gzip.compress(asset.read_bytes(), compresslevel=9))
+            os.replace(tmp_path, gz_path)
+            count += 1
+    if count:
+        logger.info(f"Precompressed {count} frontend assets")
+
 if frontend_dist_path.exists():
     app.mount("/static", StaticFiles(directory=str(frontend_dist_path / "assets")), name="static")
 
+    @app.middleware("http")
+    async def static_cache_headers(request: Request, call_next):
+        """Mark hashed bundle assets as immutable so clients cache them"""
+        response = await call_next(request)
+        if request.url.path.startswith("/static/"):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
     @app.get("/{path:path}")
-    async def serve_frontend(path: str):
-        """Serve frontend files"""
+    async def serve_frontend(path: str, request: Request):
+        """Serve frontend files, preferring precompressed .gz assets"""
         if path.startswith("api/"):
             raise HTTPException(status_code=404, detail="API endpoint not found")
 
         file_path = frontend_dist_path / path
-        if file_path.exists() and file_path.is_file():
-            return FileResponse(file_path)
-        else:
+        if not (file_path.exists() and file_path.is_file()):
             # Return index.html for client-side routing
-            return FileResponse(frontend_dist_path / "index.html")
+            file_path = frontend_dist_path / "index.html"
+
+        gz_path = file_path.with_suffix(file_path.suffix + ".gz")
+        if ("gzip" in request.headers.get("accept-encoding", "") and
+                gz_path.is_file()):
+            media_type, _ = mimetypes.guess_type(str(file_path))
+            return FileResponse(
+                gz_path,
+                media_type=media_type,
+                headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"}
+            )
+        # Vary on both branches so caches never pin one variant for everyone
+        return FileResponse(file_path, headers={"Vary": "Accept-Encoding"})
 
 # Note: For development, use run.py in the backend directory
 # For production, use: uvicorn app.main:app --host 0.0.0.0 --port 8000
\ No newline at end of file
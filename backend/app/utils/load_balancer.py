@@ -1,6 +1,10 @@
 import asyncio
+import hashlib
+import heapq
 import time
-from typing import List, Dict, Optional
+from collections import Counter
+from pathlib import Path
+from typing import Callable, ClassVar, List, Dict, Optional
 from dataclasses import dataclass, field
 from enum import Enum
 import logging
@@ -14,28 +18,56 @@ class KeyStatus(Enum):
 
 @dataclass
 class APIKeyInfo:
+    # Rate limits per key: IPM=2 (token bucket), IPD=400 (daily counter)
+    RPM_CAPACITY: ClassVar[float] = 2.0
+    RPM_REFILL_RATE: ClassVar[float] = 2.0 / 60.0  # tokens per second
+    DAILY_LIMIT: ClassVar[int] = 400
+
     key: str
     status: KeyStatus = KeyStatus.ACTIVE
-    requests_per_minute: int = 0
+    tokens: float = 2.0
+    last_refill: float = field(default_factory=time.monotonic)
     requests_per_day: int = 0
     last_request_time: float = 0
-    last_reset_minute: int = 0
     last_reset_day: int = 0
     consecutive_failures: int = 0
     last_failure_time: float = 0
+    # Monotonic deadline from an upstream Retry-After header; takes
+    # precedence over our own token bucket while it is in the future
+    rate_limited_until: float = 0.0
+    # Set by the owning LoadBalancer to keep aggregate counters current
+    on_status_change: Optional[Callable[["APIKeyInfo", KeyStatus, KeyStatus], None]] = \
+        field(default=None, repr=False, compare=False)
+
+    def _set_status(self, new_status: KeyStatus):
+        """Change status, notifying the owner of the transition"""
+        if new_status is self.status:
+            return
+        old_status = self.status
+        self.status = new_status
+        if self.on_status_change is not None:
+            self.on_status_change(self, old_status, new_status)
 
     def reset_counters_if_needed(self):
-        """Reset request counters based on time periods"""
-        current_time = time.time()
-        current_minute = int(current_time // 60)
-        current_day = int(current_time // 86400)
-
-        # Reset minute counter
-        if current_minute != self.last_reset_minute:
-            self.requests_per_minute = 0
-            self.last_reset_minute = current_minute
+        """Refill the per-minute token bucket and reset the daily counter.
+
+        All accounting uses time.monotonic() so NTP adjustments can never
+        corrupt the arithmetic. Day boundaries are therefore measured from
+        process start, meaning daily quotas reset on restart - acceptable
+        since the upstream IPD counter resets on its own schedule anyway.
+        """
+        current_time = time.monotonic()
+
+        # Continuous refill smooths bursts instead of resetting on minute
+        # boundaries, so dispatch never exceeds the intended rate
+        self.tokens = min(
+            self.RPM_CAPACITY,
+            self.tokens + (current_time - self.last_refill) * self.RPM_REFILL_RATE
+        )
+        self.last_refill = current_time
 
         # Reset day counter
+        current_day = int(current_time // 86400)
         if current_day != self.last_reset_day:
             self.requests_per_day = 0
             self.last_reset_day = current_day
@@ -43,7 +75,7 @@ class APIKeyInfo:
         # Reset failure status after cooldown period (5 minutes)
         if (self.status == KeyStatus.FAILED and
             current_time - self.last_failure_time > 300):
-            self.status = KeyStatus.ACTIVE
+            self._set_status(KeyStatus.ACTIVE)
             self.consecutive_failures = 0
 
     def can_make_request(self) -> bool:
@@ -53,9 +85,15 @@ class APIKeyInfo:
         if self.status == KeyStatus.FAILED:
             return False
 
-        # Rate limits: IPM=2, IPD=400
-        if self.requests_per_minute >= 2 or self.requests_per_day >= 400:
-            self.status = KeyStatus.RATE_LIMITED
+        # Honor an explicit upstream reset time before our own accounting
+        if self.rate_limited_until:
+            if time.monotonic() < self.rate_limited_until:
+                self._set_status(KeyStatus.RATE_LIMITED)
+                return False
+            self.rate_limited_until = 0.0
+
+        if self.tokens < 1.0 or self.requests_per_day >= self.DAILY_LIMIT:
+            self._set_status(KeyStatus.RATE_LIMITED)
             return False
 
         return True
@@ -63,115 +101,307 @@ class APIKeyInfo:
     def record_request(self):
         """Record a successful request"""
         self.reset_counters_if_needed()
-        self.requests_per_minute += 1
+        self.tokens -= 1.0
         self.requests_per_day += 1
-        self.last_request_time = time.time()
+        self.last_request_time = time.monotonic()
         self.consecutive_failures = 0
 
-        # Update status based on new counts
-        if self.requests_per_minute >= 2 or self.requests_per_day >= 400:
-            self.status = KeyStatus.RATE_LIMITED
+        # Update status based on remaining quota
+        if self.tokens < 1.0 or self.requests_per_day >= self.DAILY_LIMIT:
+            self._set_status(KeyStatus.RATE_LIMITED)
         else:
-            self.status = KeyStatus.ACTIVE
+            self._set_status(KeyStatus.ACTIVE)
 
     def record_failure(self):
         """Record a failed request"""
         self.consecutive_failures += 1
-        self.last_failure_time = time.time()
+        self.last_failure_time = time.monotonic()
 
         # Mark as failed after 3 consecutive failures
         if self.consecutive_failures >= 3:
-            self.status = KeyStatus.FAILED
+            self._set_status(KeyStatus.FAILED)
 
 class LoadBalancer:
+    # How long a computed stats snapshot stays valid
+    STATS_TTL: ClassVar[float] = 0.5
+    # How long a sticky affinity binding lasts before being recomputed,
+    # so no key stays pinned to a hot prompt forever
+    STICKY_TTL: ClassVar[float] = 600.0
+    # Hard cap on remembered bindings; unique prompts would otherwise
+    # accumulate entries that no lookup ever revisits to expire
+    STICKY_MAX_BINDINGS: ClassVar[int] = 4096
+
     def __init__(self, api_keys: List[str]):
         self.keys: Dict[str, APIKeyInfo] = {
             key: APIKeyInfo(key=key) for key in api_keys
         }
-        self.last_used_index = 0
+        # Incremental status counts so /stats and /health never scan all keys
+        self._status_counts = Counter({KeyStatus.ACTIVE: len(self.keys)})
+        # Running request totals, reset on their own time windows
+        self._total_rpd = 0
+        self._total_rpm = 0
+        self._totals_minute = int(time.monotonic() // 60)
+        self._totals_day = int(time.monotonic() // 86400)
+        self._stats_cache: Optional[Dict] = None
+        self._stats_cache_time = 0.0
+        # Sticky affinity bindings: affinity -> (key, monotonic expiry)
+        self._sticky_bindings: Dict[str, tuple] = {}
+        for key_info in self.keys.values():
+            key_info.on_status_change = self._on_status_change
+        # Min-heap of (requests_per_day, -tokens, version, key) so the least
+        # used key is always selectable in O(log N).
+        # Stale entries are invalidated lazily via the version counter.
+        self._heap: List[tuple] = []
+        self._versions: Dict[str, int] = {}
+        self._version_counter = 0
+        for key_info in self.keys.values():
+            self._requeue(key_info)
+        # Guards counter mutations so parallel dispatch cannot double-spend quota
+        self._lock = asyncio.Lock()
+
+    def _requeue(self, key_info: APIKeyInfo):
+        """Push a fresh heap entry for a key, invalidating any older entries"""
+        self._version_counter += 1
+        self._versions[key_info.key] = self._version_counter
+        heapq.heappush(self._heap, (
+            key_info.requests_per_day,
+            -key_info.tokens,
+            self._version_counter,
+            key_info.key
+        ))
+
+    def _pop_usable_keys(self, count: int) -> List[APIKeyInfo]:
+        """Pop up to 'count' distinct usable keys, discarding stale heap entries"""
+        selected = []
+        unusable = []
+        while self._heap and len(selected) < count:
+            _, _, version, key = heapq.heappop(self._heap)
+            if version != self._versions.get(key):
+                continue  # Stale entry, a newer one exists in the heap
+            key_info = self.keys[key]
+            key_info.reset_counters_if_needed()
+            if key_info.can_make_request():
+                selected.append(key_info)
+            else:
+                unusable.append(key_info)
+
+        # Re-queue everything we touched so keys stay selectable later
+        for key_info in selected:
+            self._requeue(key_info)
+        for key_info in unusable:
+            self._requeue(key_info)
+
+        return selected
 
     def get_available_key(self) -> Optional[str]:
-        """Get an available API key using round-robin with health checking"""
-        available_keys = [
-            key_info for key_info in self.keys.values()
-            if key_info.can_make_request()
-        ]
-
-        if not available_keys:
+        """Get the least used available API key"""
+        selected = self._pop_usable_keys(1)
+        if not selected:
             logger.warning("No available API keys")
             return None
-
-        # Sort by usage to prefer less used keys
-        available_keys.sort(key=lambda k: (k.requests_per_day, k.requests_per_minute))
-
-        # Use round-robin among available keys
-        selected_key = available_keys[self.last_used_index % len(available_keys)]
-        self.last_used_index = (self.last_used_index + 1) % len(available_keys)
-
-        return selected_key.key
+        return selected[0].key
 
     def get_multiple_available_keys(self, count: int) -> List[str]:
         """Get multiple available API keys for parallel requests"""
-        available_keys = [
-            key_info for key_info in self.keys.values()
-            if key_info.can_make_request()
-        ]
-
-        if not available_keys:
+        selected = self._pop_usable_keys(count)
+        if not selected:
             logger.warning("No available API keys")
-            return []
-
-        # Sort by usage to prefer less used keys
-        available_keys.sort(key=lambda k: (k.requests_per_day, k.requests_per_minute))
-
-        # Return up to 'count' keys, cycling through available ones
-        selected_keys = []
-        for i in range(min(count, len(available_keys) * 2)):  # Allow some cycling
-            key_index = (self.last_used_index + i) % len(available_keys)
-            selected_key = available_keys[key_index]
-
-            # Check if we can still use this key
-            if selected_key.can_make_request():
-                selected_keys.append(selected_key.key)
-                if len(selected_keys) >= count:
-                    break
-
-        self.last_used_index = (self.last_used_index + len(selected_keys)) % len(available_keys)
-        return selected_keys
+        return [key_info.key for key_info in selected]
+
+    def _roll_total_windows(self):
+        """Reset the running totals when their time windows elapse"""
+        now = time.monotonic()
+        minute = int(now // 60)
+        if minute != self._totals_minute:
+            self._total_rpm = 0
+            self._totals_minute = minute
+        day = int(now // 86400)
+        if day != self._totals_day:
+            self._total_rpd = 0
+            self._totals_day = day
+
+    def _reserve(self, key_info: APIKeyInfo):
+        """Count a request against a key at dispatch time"""
+        key_info.record_request()
+        self._roll_total_windows()
+        self._total_rpd += 1
+        self._total_rpm += 1
+        self._requeue(key_info)
+
+    async def acquire_key(self) -> Optional[str]:
+        """Atomically select the least used available key and reserve quota on it"""
+        async with self._lock:
+            selected = self._pop_usable_keys(1)
+            if not selected:
+                logger.warning("No available API keys")
+                return None
+            self._reserve(selected[0])
+            return selected[0].key
+
+    async def acquire_keys(self, count: int) -> List[str]:
+        """Atomically reserve quota on up to 'count' distinct keys"""
+        async with self._lock:
+            selected = self._pop_usable_keys(count)
+            if not selected:
+                logger.warning("No available API keys")
+            for key_info in selected:
+                self._reserve(key_info)
+            return [key_info.key for key_info in selected]
+
+    def pick_sticky_key(self, affinity: str) -> Optional[str]:
+        """Pick a key deterministically for an affinity string.
+
+        Repeat requests with the same affinity hit the same key so any
+        upstream caching keyed on the API key can be reused. Bindings
+        expire after STICKY_TTL and reallocate when the key becomes
+        unavailable, so load stays balanced over time.
+        """
+        now = time.monotonic()
+        binding = self._sticky_bindings.get(affinity)
+        if binding is not None:
+            key, expiry = binding
+            key_info = self.keys.get(key)
+            if (now < expiry and key_info is not None and
+                    key_info.can_make_request()):
+                return key
+            del self._sticky_bindings[affinity]
+
+        # Hash over currently available keys only, so a down key reallocates
+        available = [k for k in self.keys.values() if k.can_make_request()]
+        if not available:
+            return None
+        digest = int.from_bytes(
+            hashlib.blake2b(affinity.encode(), digest_size=8).digest(), "big"
+        )
+        selected = available[digest % len(available)]
+        if len(self._sticky_bindings) >= self.STICKY_MAX_BINDINGS:
+            self._prune_sticky_bindings(now)
+        self._sticky_bindings[affinity] = (selected.key, now + self.STICKY_TTL)
+        return selected.key
+
+    def _prune_sticky_bindings(self, now: float):
+        """Drop expired bindings; evict oldest ones if still at the cap"""
+        expired = [
+            affinity for affinity, (_, expiry) in self._sticky_bindings.items()
+            if now >= expiry
+        ]
+        for affinity in expired:
+            del self._sticky_bindings[affinity]
+        # Insertion order doubles as age order, so shed from the front
+        while len(self._sticky_bindings) >= self.STICKY_MAX_BINDINGS:
+            del self._sticky_bindings[next(iter(self._sticky_bindings))]
+
+    async def acquire_sticky_key(self, affinity: str) -> Optional[str]:
+        """Atomically pick the sticky key for an affinity and reserve quota on it"""
+        async with self._lock:
+            key = self.pick_sticky_key(affinity)
+            if key is None:
+                logger.warning("No available API keys")
+                return None
+            self._reserve(self.keys[key])
+            return key
+
+    async def reserve_extra(self, api_key: str):
+        """Reserve an additional slot on a key, even past its quota.
+
+        Used by the parallel fallback that reuses already-reserved keys:
+        charging the reuse keeps every dispatch matched by one reservation,
+        so failure-path releases cannot refund more than was spent.
+        """
+        async with self._lock:
+            key_info = self.keys.get(api_key)
+            if key_info is not None:
+                self._reserve(key_info)
+
+    async def release_reservation(self, api_key: str):
+        """Give back quota reserved at acquire time for a request that never counted upstream"""
+        async with self._lock:
+            key_info = self.keys.get(api_key)
+            if key_info is None:
+                return
+            key_info.tokens = min(APIKeyInfo.RPM_CAPACITY, key_info.tokens + 1.0)
+            key_info.requests_per_day = max(0, key_info.requests_per_day - 1)
+            self._roll_total_windows()
+            self._total_rpd = max(0, self._total_rpd - 1)
+            self._total_rpm = max(0, self._total_rpm - 1)
+            if (key_info.status == KeyStatus.RATE_LIMITED and
+                key_info.tokens >= 1.0 and
+                key_info.requests_per_day < APIKeyInfo.DAILY_LIMIT):
+                key_info._set_status(KeyStatus.ACTIVE)
+            self._requeue(key_info)
 
     def record_success(self, api_key: str):
-        """Record a successful API request"""
+        """Record a successful API request (quota was already reserved at acquire time)"""
         if api_key in self.keys:
-            self.keys[api_key].record_request()
+            key_info = self.keys[api_key]
+            key_info.consecutive_failures = 0
+            key_info.last_request_time = time.monotonic()
 
     def record_failure(self, api_key: str):
         """Record a failed API request"""
         if api_key in self.keys:
             self.keys[api_key].record_failure()
+            self._requeue(self.keys[api_key])
 
-    def get_stats(self) -> Dict:
-        """Get load balancer statistics"""
-        active_keys = sum(1 for k in self.keys.values() if k.status == KeyStatus.ACTIVE)
-        rate_limited_keys = sum(1 for k in self.keys.values() if k.status == KeyStatus.RATE_LIMITED)
-        failed_keys = sum(1 for k in self.keys.values() if k.status == KeyStatus.FAILED)
-
-        total_requests_today = sum(k.requests_per_day for k in self.keys.values())
-        total_requests_this_minute = sum(k.requests_per_minute for k in self.keys.values())
+    def record_rate_limit(self, api_key: str, retry_after: Optional[float] = None):
+        """Record an upstream 429, honoring its Retry-After hint when given"""
+        if api_key in self.keys:
+            key_info = self.keys[api_key]
+            key_info.record_failure()
+            if retry_after is not None:
+                key_info.rate_limited_until = time.monotonic() + retry_after
+                key_info._set_status(KeyStatus.RATE_LIMITED)
+            self._requeue(key_info)
+
+    def _on_status_change(self, key_info: APIKeyInfo, old_status: KeyStatus, new_status: KeyStatus):
+        """Keep the aggregate status counters in sync with key transitions"""
+        self._status_counts[old_status] -= 1
+        self._status_counts[new_status] += 1
+        self._stats_cache = None
 
-        return {
+    def get_stats(self) -> Dict:
+        """Get load balancer statistics in O(1)"""
+        now = time.monotonic()
+        if (self._stats_cache is not None and
+            now - self._stats_cache_time < self.STATS_TTL):
+            return self._stats_cache
+
+        self._roll_total_windows()
+        self._stats_cache = {
             "total_keys": len(self.keys),
-            "active_keys": active_keys,
-            "rate_limited_keys": rate_limited_keys,
-            "failed_keys": failed_keys,
-            "total_requests_today": total_requests_today,
-            "total_requests_this_minute": total_requests_this_minute
+            "active_keys": self._status_counts[KeyStatus.ACTIVE],
+            "rate_limited_keys": self._status_counts[KeyStatus.RATE_LIMITED],
+            "failed_keys": self._status_counts[KeyStatus.FAILED],
+            "total_requests_today": self._total_rpd,
+            "total_requests_this_minute": self._total_rpm
         }
+        self._stats_cache_time = now
+        return self._stats_cache
+
+# Candidate locations for keys.txt, resolved once and memoized
+_KEYS_FILE_CANDIDATES = (
+    Path("keys.txt"),
+    Path("../keys.txt"),
+    Path(__file__).resolve().parent.parent.parent.parent / "keys.txt"
+)
+_keys_file_path: Optional[Path] = None
+
+def _resolve_keys_file() -> Optional[Path]:
+    """Find the keys.txt file, remembering the winning candidate"""
+    global _keys_file_path
+    if _keys_file_path is None:
+        for candidate in _KEYS_FILE_CANDIDATES:
+            if candidate.is_file():
+                _keys_file_path = candidate
+                break
+    return _keys_file_path
 
 def load_api_keys_from_file(file_path: str) -> List[str]:
     """Load API keys from a text file"""
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            keys = [line.strip() for line in f if line.strip()]
+        # Single read instead of per-line iteration over the file object
+        lines = Path(file_path).read_text(encoding='utf-8').splitlines()
+        keys = [line.strip() for line in lines if line.strip()]
         logger.info(f"Loaded {len(keys)} API keys from {file_path}")
         return keys
     except FileNotFoundError:
@@ -188,19 +418,8 @@ def get_load_balancer() -> LoadBalancer:
     """Get the global load balancer instance"""
     global _load_balancer
     if _load_balancer is None:
-        # Try different paths for keys.txt
-        import os
-        possible_paths = [
-            "keys.txt",
-            "../keys.txt",
-            os.path.join(os.path.dirname(__file__), "..", "..", "..", "keys.txt")
-        ]
-
-        api_keys = []
-        for path in possible_paths:
-            api_keys = load_api_keys_from_file(path)
-            if api_keys:
-                break
+        keys_file = _resolve_keys_file()
+        api_keys = load_api_keys_from_file(str(keys_file)) if keys_file else []
 
         if not api_keys:
             logger.warning("No API keys found, creating dummy load balancer for development")
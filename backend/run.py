@@ -2,9 +2,12 @@
 """
 Startup script for the AI Drawing Studio backend.
 
-This script properly configures the Python path and starts the FastAPI application.
+This script properly configures the Python path and starts the FastAPI
+application. Set PROD=1 to run with production settings (multiple workers,
+uvloop event loop, httptools parser, no reloader).
 """
 
+import os
 import sys
 from pathlib import Path
 
@@ -12,14 +15,46 @@ from pathlib import Path
 backend_dir = Path(__file__).parent
 sys.path.insert(0, str(backend_dir))
 
+def _enable_io_uring():
+    """Opt uvloop into io_uring on kernels that support it (Linux >= 5.6).
+
+    io_uring batches socket reads/writes, cutting per-request syscall count;
+    the benefit flows through the shared httpx client's sockets. For NUMA
+    hosts, pin workers to cores with `taskset -c` when starting this script.
+    """
+    if sys.platform != "linux":
+        return
+    release = os.uname().release.split("-")[0]
+    try:
+        major, minor = (int(part) for part in release.split(".")[:2])
+    except ValueError:
+        return
+    if (major, minor) >= (5, 6):
+        os.environ.setdefault("UV_USE_IO_URING", "1")
+
 if __name__ == "__main__":
     import uvicorn
 
-    # Run the application using import string for reload support
-    uvicorn.run(
-        "app.main:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True,
-        log_level="info"
-    )
\ No newline at end of file
+    if os.getenv("PROD"):
+        # Production: saturate all cores and skip the file-watcher subprocess.
+        # uvloop/httptools ship with uvicorn[standard].
+        _enable_io_uring()
+        uvicorn.run(
+            "app.main:app",
+            host="0.0.0.0",
+            port=8000,
+            workers=os.cpu_count(),
+            loop="uvloop",
+            http="httptools",
+            reload=False,
+            log_level="warning"
+        )
+    else:
+        # Development: run the application with reload support
+        uvicorn.run(
+            "app.main:app",
+            host="0.0.0.0",
+            port=8000,
+            reload=True,
+            log_level="info"
+        )